@@ -2,10 +2,13 @@ import cv2
 import numpy as np
 import time
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import NetworkError, RetryAfter, TelegramError
 import asyncio
+import io
 import logging
 import os
+import re
+import threading
 from dotenv import load_dotenv
 from datetime import datetime, time as dt_time, timedelta
 
@@ -23,9 +26,35 @@ if not TELEGRAM_TOKEN or not CHAT_ID:
 # Motion detection settings
 MIN_CONTOUR_AREA = 5000
 SEND_INTERVAL = 3
+SEND_INTERVAL_MAX = 30  # Interval grows up to this while motion continues
+SEND_RETRIES = 3  # Attempts per photo when Telegram asks to retry later
+PROCESS_SCALE = 0.5  # Frames are downscaled by this factor before motion analysis
+JPEG_QUALITY = 85  # JPEG quality of photos sent to Telegram
+PROCESS_EVERY_N = 2  # Run motion detection on every Nth frame
+MOG2_HISTORY = 250  # Frames used to build the background model
+MOG2_VAR_THRESHOLD = 25  # Pixel-to-model distance threshold for foreground
+PREFILTER_SCALE = 0.125  # Scale of the thumbnail used for the cheap change check
+PREFILTER_PIXEL_THRESHOLD = 10  # Thumbnail pixel difference counted as changed
+PREFILTER_AREA_FRACTION = 0.25  # Share of the min blob area that must change to run the model
+PREFILTER_REFRESH_EVERY = 10  # Static frames still fed to the background model every Nth time
+
+# Camera capture settings
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+CAMERA_FPS = 15
+
+# Run background subtraction on the GPU (only worth it for large frames)
+USE_CUDA = os.getenv('USE_CUDA') == '1'
+CUDA_MIN_PIXELS = 1280 * 720  # Min processed frame size (after PROCESS_SCALE) for CUDA
+
+# Use a running-average background model instead of MOG2 on low-end hardware
+USE_SIMPLE_BG = os.getenv('USE_SIMPLE_BG') == '1'
+SIMPLE_BG_ALPHA = 0.02  # Background update rate per processed frame
+SIMPLE_BG_THRESHOLD = 25  # Pixel difference from background counted as foreground
 
 # Daily photo settings
 DAILY_PHOTO_TIME = dt_time(14, 00)  # 14:00 (2 PM)
+SCHEDULER_CHECK_INTERVAL = 60  # Max seconds between wall-clock re-checks
 
 # Custom formatter to mask sensitive data
 class SecureFormatter(logging.Formatter):
@@ -33,14 +62,19 @@ class SecureFormatter(logging.Formatter):
         super().__init__(fmt, datefmt, style)
         self.secrets = secrets or []
 
+        # Single pattern matching all secrets, so each message is scanned once.
+        # Only mask strings longer than 4 chars; longest first so overlapping
+        # secrets are fully masked
+        masked = sorted((s for s in self.secrets if s and len(s) > 4), key=len, reverse=True)
+        self._pattern = re.compile('|'.join(map(re.escape, masked))) if masked else None
+
     def format(self, record):
         # Format the message first
         formatted = super().format(record)
 
         # Mask all sensitive data
-        for secret in self.secrets:
-            if secret and len(secret) > 4:  # Only mask strings longer than 4 chars
-                formatted = formatted.replace(secret, '***')
+        if self._pattern:
+            formatted = self._pattern.sub('***', formatted)
         return formatted
 
 # Setup secure logging
@@ -78,43 +112,149 @@ class MotionDetector:
 
         self.bot = Bot(token=TELEGRAM_TOKEN)
         self.cap = cv2.VideoCapture(0)
-        self.last_sent = 0
+        # Request compressed MJPG at a fixed low resolution to cut USB bandwidth
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        self.cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS)
+        # Keep driver-side queue minimal so grabbed frames are fresh
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Newest motion frame waiting for upload - newer motion replaces it
+        self._motion_photo = None
+        self._motion_event = asyncio.Event()
+
         self.frame_count = 0
         self.latest_frame = None  # Store latest frame for scheduled photo
 
+        # Camera frames are read in a background thread
+        self._lock = threading.Lock()
+        self._grabbed = None
+        self._grabbing = False
+        self._grab_thread = None
+        self._frame_event = None
+
+        # Contour area threshold in downscaled pixels
+        self._min_area = MIN_CONTOUR_AREA * PROCESS_SCALE ** 2
+        # Downscaled frame buffer, reused between frames
+        self._small = None
+        # Intermediate buffers, allocated on the first frame and reused
+        self._gray = None
+        self._blur = None
+        self._mask = None
+        # Thumbnails of current frame and of the last frame fed to the background
+        # model, for the change prefilter
+        self._thumb = None
+        self._ref_thumb = None
+        self._thumb_diff = None
+        # Changed thumbnail pixels that make a frame worth a full check
+        self._prefilter_area = self._min_area * PREFILTER_SCALE ** 2 * PREFILTER_AREA_FRACTION
+        # Result of the last full check - a present object keeps being checked
+        self._last_motion = False
+        # Consecutive static frames skipped since the background model was last fed
+        self._static_frames = 0
+        # Rectangular kernel allows OpenCV's fast separable erode/dilate
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
         # Configure background subtractor
-        self.back_sub = cv2.createBackgroundSubtractorMOG2(
-            history=500,
-            varThreshold=50,
-            detectShadows=False
-        )
+        self.use_simple_bg = USE_SIMPLE_BG
+        # Processed frame size - GPU upload only pays off for large frames
+        process_pixels = (self.cap.get(cv2.CAP_PROP_FRAME_WIDTH) *
+                          self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT) * PROCESS_SCALE ** 2)
+        self.use_cuda = (not USE_SIMPLE_BG and USE_CUDA and process_pixels >= CUDA_MIN_PIXELS
+                         and cv2.cuda.getCudaEnabledDeviceCount() > 0)
+        if self.use_simple_bg:
+            if USE_CUDA:
+                logger.warning("USE_CUDA is ignored when USE_SIMPLE_BG is set")
+            # Running average background, allocated on the first frame
+            self.back_sub = None
+            self._bg = None
+            self._bg_u8 = None
+        elif self.use_cuda:
+            self.back_sub = cv2.cuda.createBackgroundSubtractorMOG2(
+                history=MOG2_HISTORY,
+                varThreshold=MOG2_VAR_THRESHOLD,
+                detectShadows=False
+            )
+            self._stream = cv2.cuda.Stream()
+            self._gpu_gray = cv2.cuda_GpuMat()
+        else:
+            if USE_CUDA and process_pixels < CUDA_MIN_PIXELS:
+                logger.warning("USE_CUDA is set but processed frames (%d px) are below "
+                               "CUDA_MIN_PIXELS (%d px) - using CPU", process_pixels, CUDA_MIN_PIXELS)
+            elif USE_CUDA:
+                logger.warning("USE_CUDA is set but no CUDA device is available - using CPU")
+            self.back_sub = cv2.createBackgroundSubtractorMOG2(
+                history=MOG2_HISTORY,
+                varThreshold=MOG2_VAR_THRESHOLD,
+                detectShadows=False
+            )
 
         # Log safe information only
         logger.info("Motion detector initialized successfully")
         logger.info("Camera status: %s", self.cap.isOpened())
+        # Some backends (e.g. DirectShow/MSMF) report FOURCC as a negative value
+        fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC)) & 0xFFFFFFFF
+        logger.info("Camera format: %s %dx%d @ %.1f fps",
+                   fourcc.to_bytes(4, 'little').decode(errors='replace'),
+                   self.cap.get(cv2.CAP_PROP_FRAME_WIDTH),
+                   self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT),
+                   self.cap.get(cv2.CAP_PROP_FPS))
         logger.info("Min contour area: %s", MIN_CONTOUR_AREA)
         logger.info("Send interval: %s seconds", SEND_INTERVAL)
+        logger.info("Processing every %s frame(s)", PROCESS_EVERY_N)
+        logger.info("Background model: %s", "running average" if self.use_simple_bg else "MOG2")
+        logger.info("CUDA background subtraction: %s", self.use_cuda)
         logger.info("Daily photo time: %s", DAILY_PHOTO_TIME.strftime("%H:%M"))
         logger.info("Bot initialized: %s", bool(TELEGRAM_TOKEN and CHAT_ID))
 
+    async def __aenter__(self):
+        # Initialize bot so its HTTP connection pool is shut down cleanly on exit
+        try:
+            await self.bot.initialize()
+        except NetworkError as e:
+            # Network may come up after the camera - keep detecting, sends will retry
+            logger.warning("Telegram unreachable at startup - continuing: %s", str(e))
+        except BaseException:
+            self.cap.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.bot.shutdown()
+
     async def send_photo(self, frame, caption=None):
         """Asynchronously send photo to Telegram"""
         try:
-            # Save frame to temporary file
-            cv2.imwrite('motion.jpg', frame)
-            with open('motion.jpg', 'rb') as photo:
-                await self.bot.send_photo(
-                    chat_id=CHAT_ID,
-                    photo=photo,
-                    caption=caption or f'Motion detected! ({time.ctime()})'
-                )
-            logger.info("Photo sent successfully to Telegram")
-
-            # Clean up temporary file
-            try:
-                os.remove('motion.jpg')
-            except OSError:
-                pass
+            # Encode frame to JPEG in memory
+            ok, buf = await asyncio.to_thread(
+                cv2.imencode, '.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]
+            )
+            if not ok:
+                logger.error("Failed to encode frame to JPEG")
+                return
+
+            photo = buf.tobytes()
+            caption = caption or f'Motion detected! ({time.ctime()})'
+
+            for attempt in range(1, SEND_RETRIES + 1):
+                try:
+                    await self.bot.send_photo(
+                        chat_id=CHAT_ID,
+                        photo=io.BytesIO(photo),
+                        caption=caption
+                    )
+                    logger.info("Photo sent successfully to Telegram")
+                    return
+                except RetryAfter as e:
+                    # Honor Telegram flood control
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    if attempt == SEND_RETRIES:
+                        raise
+                    logger.warning("Telegram rate limit hit - retrying in %s seconds", retry_after)
+                    await asyncio.sleep(retry_after)
 
         except TelegramError as e:
             # Log error without exposing sensitive data
@@ -128,34 +268,98 @@ class MotionDetector:
         except Exception as e:
             logger.error("Unexpected error sending photo: %s", str(e))
 
+    def apply_background_subtraction(self, gray):
+        """Return foreground mask of grayscale frame"""
+        if self.use_simple_bg:
+            if self._bg is None:
+                self._bg = gray.astype(np.float32)
+
+            # Foreground is whatever differs enough from the running average
+            self._bg_u8 = cv2.convertScaleAbs(self._bg, dst=self._bg_u8)
+            self._mask = cv2.absdiff(gray, self._bg_u8, dst=self._mask)
+            cv2.threshold(self._mask, SIMPLE_BG_THRESHOLD, 255, cv2.THRESH_BINARY, dst=self._mask)
+            cv2.accumulateWeighted(gray, self._bg, SIMPLE_BG_ALPHA)
+        elif self.use_cuda:
+            self._gpu_gray.upload(gray, self._stream)
+            gpu_mask = self.back_sub.apply(self._gpu_gray, -1, self._stream)
+            self._mask = gpu_mask.download(self._stream, self._mask)
+            self._stream.waitForCompletion()
+        else:
+            self._mask = self.back_sub.apply(gray, fgmask=self._mask, learningRate=-1)
+        return self._mask
+
+    def scene_changed(self, gray):
+        """Cheaply check if grayscale frame differs from the last one fed to the model"""
+        self._thumb = cv2.resize(
+            gray, None, dst=self._thumb,
+            fx=PREFILTER_SCALE, fy=PREFILTER_SCALE,
+            interpolation=cv2.INTER_AREA
+        )
+        if self._ref_thumb is None:
+            return True
+
+        # Count changed pixels, so the test scales with the blob area threshold
+        self._thumb_diff = cv2.absdiff(self._thumb, self._ref_thumb, dst=self._thumb_diff)
+        cv2.threshold(self._thumb_diff, PREFILTER_PIXEL_THRESHOLD, 255,
+                      cv2.THRESH_BINARY, dst=self._thumb_diff)
+        return cv2.countNonZero(self._thumb_diff) >= self._prefilter_area
+
+    def detect_motion(self, gray):
+        """Run background model on grayscale frame and check for large blobs"""
+        # Apply background subtraction
+        fg_mask = self.apply_background_subtraction(gray)
+
+        # Morphological opening to reduce noise
+        cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, self._kernel, dst=fg_mask)
+
+        # No blob can exceed the threshold if the whole mask does not
+        if cv2.countNonZero(fg_mask) <= self._min_area:
+            return False
+
+        # Label connected blobs and get their pixel areas
+        _, _, stats, _ = cv2.connectedComponentsWithStats(fg_mask, connectivity=8)
+
+        # Check if any blob is significant (label 0 is the background)
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        motion_detected = bool((areas > self._min_area).any())
+        if motion_detected:
+            logger.debug("Significant motion detected - blob area: %s", areas.max())
+
+        return motion_detected
+
     def process_frame(self, frame):
         """Process frame and detect motion"""
         try:
+            # Downscale frame - the full-resolution frame is only needed for sending
+            self._small = cv2.resize(
+                frame, None, dst=self._small,
+                fx=PROCESS_SCALE, fy=PROCESS_SCALE,
+                interpolation=cv2.INTER_AREA
+            )
+
             # Reduce noise and convert to grayscale
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            gray = cv2.GaussianBlur(gray, (21, 21), 0)
-
-            # Apply background subtraction
-            fg_mask = self.back_sub.apply(gray)
-
-            # Morphological operations to reduce noise
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-            fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel)
-            fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, kernel)
-
-            # Find contours
-            contours, _ = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Check if any contour is significant
-            motion_detected = False
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                if area > MIN_CONTOUR_AREA:
-                    motion_detected = True
-                    logger.debug("Significant motion detected - contour area: %s", area)
-                    break
+            self._gray = cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+            # Three box blur passes approximate a Gaussian at a fraction of the cost
+            self._blur = cv2.blur(self._gray, (7, 7), dst=self._blur)
+            cv2.blur(self._blur, (7, 7), dst=self._gray)
+            cv2.blur(self._gray, (7, 7), dst=self._blur)
+            gray = self._blur
 
-            return motion_detected
+            # Skip background subtraction if the scene has not changed noticeably
+            # since the model last saw it and no motion was present then, but
+            # still feed some static frames so the model follows slow drift
+            if not self.scene_changed(gray) and not self._last_motion:
+                self._static_frames += 1
+                if self._static_frames < PREFILTER_REFRESH_EVERY:
+                    return False
+            self._static_frames = 0
+
+            # Frame reaches the background model - it becomes the new reference
+            self._thumb, self._ref_thumb = self._ref_thumb, self._thumb
+
+            self._last_motion = self.detect_motion(gray)
+            return self._last_motion
 
         except Exception as e:
             logger.error("Error processing frame: %s", str(e))
@@ -182,61 +386,125 @@ class MotionDetector:
                        scheduled_datetime.strftime("%Y-%m-%d %H:%M:%S"),
                        seconds_until_scheduled / 3600)
 
-            # Wait until scheduled time
-            await asyncio.sleep(seconds_until_scheduled)
+            # Wait until scheduled time, re-checking the wall clock periodically
+            # so clock steps (NTP, DST, suspend) don't make the photo misfire
+            while seconds_until_scheduled > 0:
+                await asyncio.sleep(min(seconds_until_scheduled, SCHEDULER_CHECK_INTERVAL))
+                seconds_until_scheduled = (scheduled_datetime - datetime.now()).total_seconds()
 
             # Send photo if we have a frame
             if self.latest_frame is not None:
                 logger.info("Sending scheduled daily photo")
                 await self.send_photo(
                     self.latest_frame,
-                    f'Daily photo at {DAILY_PHOTO_TIME} ({datetime.now().strftime("%Y-%m-%d %H:%M")})'
+                    f'Daily photo at {DAILY_PHOTO_TIME} ({scheduled_datetime.strftime("%Y-%m-%d %H:%M")})'
                 )
             else:
                 logger.warning("No frame available for daily photo")
 
+    async def photo_uploader(self):
+        """Background task that sends the newest motion photo"""
+        interval = SEND_INTERVAL
+        while True:
+            await self._motion_event.wait()
+            self._motion_event.clear()
+            frame, caption = self._motion_photo
+            self._motion_photo = None
+            await self.send_photo(frame, caption)
+
+            # Respect minimum interval between sends - motion meanwhile only
+            # replaces the pending photo, so the next send shows the newest frame
+            await asyncio.sleep(interval)
+
+            # Back off while motion continues, reset once the scene is quiet
+            if self._motion_event.is_set():
+                interval = min(interval * 2, SEND_INTERVAL_MAX)
+            else:
+                interval = SEND_INTERVAL
+
+    def _grab_loop(self, loop):
+        """Read camera frames, keeping only the newest one"""
+        try:
+            while self._grabbing:
+                ret, frame = self.cap.read()
+                with self._lock:
+                    self._grabbed = (ret, frame)
+                try:
+                    loop.call_soon_threadsafe(self._frame_event.set)
+                except RuntimeError:
+                    # Event loop is closed
+                    break
+                if not ret:
+                    break
+        finally:
+            # Release camera here so it is never released during a read
+            self.cap.release()
+
     async def run(self):
         """Main program loop"""
         logger.info("Starting motion detector...")
 
+        # Start camera grabber thread
+        self._frame_event = asyncio.Event()
+        self._grabbing = True
+        self._grab_thread = threading.Thread(
+            target=self._grab_loop,
+            args=(asyncio.get_running_loop(),),
+            daemon=True
+        )
+        self._grab_thread.start()
+
         try:
             while True:
-                ret, frame = self.cap.read()
+                # Wait for the grabber thread to deliver a new frame
+                await self._frame_event.wait()
+                self._frame_event.clear()
+                with self._lock:
+                    grabbed, self._grabbed = self._grabbed, None
+                if grabbed is None:
+                    # Frame was already taken after an earlier wake-up
+                    continue
+
+                ret, frame = grabbed
                 if not ret:
                     logger.error("Error reading frame from camera")
                     break
 
-                # Store latest frame for scheduled photo
-                self.latest_frame = frame.copy()
-
-                motion = self.process_frame(frame)
-                current_time = time.time()
-
-                if motion and (current_time - self.last_sent) > SEND_INTERVAL:
-                    logger.info("Motion detected - preparing to send photo")
-                    await self.send_photo(frame)
-                    self.last_sent = current_time
-
-                # Limit frame processing rate
-                await asyncio.sleep(0.1)
+                # Store latest frame for scheduled photo - read() returns a
+                # fresh buffer every call, so no copy is needed
+                self.latest_frame = frame
+
+                # Motion is coherent across adjacent frames - skip some of them
+                self.frame_count += 1
+                motion = False
+                if self.frame_count % PROCESS_EVERY_N == 0:
+                    # OpenCV releases the GIL, so processing runs off the event loop
+                    motion = await asyncio.to_thread(self.process_frame, frame)
+                if motion:
+                    if self._motion_photo is None:
+                        logger.info("Motion detected - queueing photo")
+                    self._motion_photo = (frame, f'Motion detected! ({time.ctime()})')
+                    self._motion_event.set()
 
         except KeyboardInterrupt:
             logger.info("Received interrupt signal - shutting down")
         except Exception as e:
             logger.error("Unexpected error in main loop: %s", str(e))
         finally:
-            self.cap.release()
+            # Stop grabber thread - it releases the camera once its read returns
+            self._grabbing = False
+            await asyncio.to_thread(self._grab_thread.join, 1)
             logger.info("Motion detector stopped")
 
 async def main():
     try:
-        detector = MotionDetector()
-
-        # Run both motion detection and daily scheduler concurrently
-        await asyncio.gather(
-            detector.run(),
-            detector.daily_photo_scheduler()
-        )
+        async with MotionDetector() as detector:
+            # Run motion detection, photo uploads and daily scheduler concurrently
+            await asyncio.gather(
+                detector.run(),
+                detector.photo_uploader(),
+                detector.daily_photo_scheduler()
+            )
     except ValueError as e:
         logger.error("Configuration error: %s", e)
     except Exception as e: